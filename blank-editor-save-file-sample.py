@@ -2,7 +2,8 @@
 # INSTRUCTIONS:
 # -------------
 # This script is organized as a simple Python-based no-dependency webserver. In the beginning you will find
-# some functions used to make API calls. Next, in the `do_GET()` function of `SimpleHTTPRequestHandler` you will find HTML code which displays the editor.
+# some functions used to make API calls. Next, in the `_HTML_TEMPLATE` variable you will find HTML code which displays the editor,
+# it is sent to the browser by the `do_GET()` function of `SimpleHTTPRequestHandler`.
 # And next, in the `do_POST()` function you will find a code which converts a design created in the editor to a JPEG file.
 #
 # To test it, login to your Customer's Canvas account, create the Integration and External App
@@ -17,14 +18,23 @@
 # 2. If you login to Customer's Canvas and visit the Projects section, you will see a Project corresponding to this design. 
 ######################
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-import json
+import shutil
+import signal
+import threading
 import urllib3
 import time
 
+# orjson is used to serialize and parse JSON if it is installed, it is noticeably faster than the built-in 
+# json module. Otherwise, the script works with the standard library only.
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    from json import dumps as _dumps, loads as _loads
+
 ######################
 # CONFIGURATION      #
 ######################
@@ -52,7 +62,20 @@ auth_url = 'https://customerscanvashub.com/connect/token'
 # Customer's Canvas API Gateway address to make calls to the most of its API (except of the Design Editor Web API). 
 base_api_url = 'https://api.customerscanvashub.com/'
 
-client = urllib3.PoolManager()
+# All API calls go through this connection pool, so the TCP/TLS connections to Customer's Canvas hosts
+# are reused between calls (HTTP/1.1 keeps connections alive by default). Failed idempotent requests and typical "try again later"
+# responses are retried a few times with a short backoff.
+client = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=16,
+    block=False,
+    retries=urllib3.Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+    timeout=urllib3.Timeout(connect=5, read=30)
+)
+
+# Set when the server is stopped (e.g. with Ctrl+C), so that requests waiting for the rendering results
+# don't delay the shutdown.
+_shutdown = threading.Event()
 
 
 ##########################################################
@@ -78,10 +101,24 @@ client = urllib3.PoolManager()
 # Here is a description of the Design Editor token API: 
 # https://customerscanvas.com/dev/editors/design-editor-web-app/apis/auth-tokens.html
 #
-# HINT: A wise idea would be to organize some sort of caching of these values with extending them when they expire  
-# or request new ones.
+# The access token and the tenant applications info are cached below, so that we don't have to request them 
+# on every API call. The access token is reused until shortly before it expires (the `expires_in` value of the 
+# token response), the applications info is kept for a few minutes.
+
+# Seconds before the actual expiration moment when the access token is considered expired. For short-lived
+# tokens, a tenth of their lifetime is used instead.
+max_token_expiration_buffer = 300
+
+# How long (in seconds) the tenant applications info is reused before requesting it again.
+applications_cache_ttl = 300
+
+_token_cache = {"access_token": None, "expires_at": 0}
+_applications_cache = {"applications": None, "expires_at": 0}
 
 def get_access_token():
+    if time.monotonic() < _token_cache["expires_at"]:
+        return _token_cache["access_token"]
+
     payload = {
         'client_id': client_id, 
         'client_secret': secret, 
@@ -90,19 +127,27 @@ def get_access_token():
     }
 
     r = client.request_encode_body('POST', auth_url, fields=payload, encode_multipart=False)
-    response_as_string = r.data.decode('utf8')
-    return json.loads(response_as_string)['access_token']
+    result = _loads(r.data)
+
+    _token_cache["access_token"] = result['access_token']
+    expiration_buffer = min(max_token_expiration_buffer, result['expires_in'] / 10)
+    _token_cache["expires_at"] = time.monotonic() + result['expires_in'] - expiration_buffer
+
+    return _token_cache["access_token"]
 
 def get_tenant_applications():
+    if time.monotonic() < _applications_cache["expires_at"]:
+        return _applications_cache["applications"]
+
     r = client.request(
         'GET', 
         f'{base_api_url}/api/storefront/v1/tenant-info/applications', 
         headers={"Authorization": f"Bearer {get_access_token()}"}
     )
-    response_as_string = r.data.decode('utf8')
-    r.release_conn()
+    _applications_cache["applications"] = _loads(r.data)
+    _applications_cache["expires_at"] = time.monotonic() + applications_cache_ttl
 
-    return json.loads(response_as_string)
+    return _applications_cache["applications"]
 
 def get_design_editor_url():
     return get_tenant_applications()['designEditorUrl']
@@ -111,21 +156,20 @@ def get_design_editor_apikey():
     return get_tenant_applications()['designEditorApiKey']
 
 def get_design_editor_token(user_id):
-    base_address = get_design_editor_url() 
-    api_key = get_design_editor_apikey() 
+    # Both values come from the same API response, so we request it only once.
+    applications = get_tenant_applications()
+    base_address = applications['designEditorUrl']
+    api_key = applications['designEditorApiKey']
     r = client.request(
         'POST', 
         f'{base_address}/api/Auth/Users/{user_id}/Tokens', 
         headers={"X-CustomersCanvasAPIKey": f"{api_key}"}
     )
-    response_as_string = r.data.decode('utf8')
-    r.release_conn()
-
     # Use these lines of code to debug API responses
     # print("HTTP Code: {code} {reason}, length={length}".format(code=r.status, reason=r.reason, length=len(r.data)))
-    # print("Response: " + response_as_string)
+    # print("Response: " + r.data.decode('utf8'))
 
-    return json.loads(response_as_string)["tokenId"]
+    return _loads(r.data)["tokenId"]
 
 
 def create_project(state_id, user_id, format, color_space, resolution):
@@ -147,35 +191,47 @@ def create_project(state_id, user_id, format, color_space, resolution):
     r = client.request(
         'POST', 
         f'{base_api_url}/api/storefront/v1/projects/by-scenario/render-hires?storefrontId={storefront_id}', 
-        body=json.dumps(payload), 
+        body=_dumps(payload), 
         headers={
                 "Authorization": f"Bearer {get_access_token()}",
                 "Content-Type": "application/json"
             }
             )
 
-    response_as_string = r.data.decode('utf8')
-    result = json.loads(response_as_string)
-
-    r.release_conn()
+    result = _loads(r.data)
     
     return result
 
+# The last received processing results and their ETag for each project being polled. If the server supports ETags,
+# we send it back in the `If-None-Match` header and get an empty `304 Not Modified` response while nothing has changed.
+_project_results_cache = {}
+
 def check_project_results(project_id): 
+    headers = {"Authorization": f"Bearer {get_access_token()}"}
+    cached_results = _project_results_cache.get(project_id)
+    if cached_results:
+        headers["If-None-Match"] = cached_results["etag"]
+
     r = client.request(
         'GET', 
         f'{base_api_url}/api/storefront/v1/projects/{project_id}/processing-results', 
-        headers={"Authorization": f"Bearer {get_access_token()}"})
-    
-    response_as_string = r.data.decode('utf8')
+        headers=headers)
 
+    if r.status == 304 and cached_results:
+        return cached_results["result"]
+    
     # Use these lines of code to debug API responses
     # print("HTTP Code: {code} {reason}, length={length}".format(code=r.status, reason=r.reason, length=len(r.data)))
-    # print("Response: " + response_as_string)
+    # print("Response: " + r.data.decode('utf8'))
 
-    result = json.loads(response_as_string)
+    result = _loads(r.data)
 
-    r.release_conn()
+    etag = r.headers.get('ETag')
+    if etag and result["status"] in ("Pending", "InProgress"):
+        _project_results_cache[project_id] = {"etag": etag, "result": result}
+    else:
+        # Once the rendering is finished, we won't poll this project anymore.
+        _project_results_cache.pop(project_id, None)
     
     return result
 
@@ -183,62 +239,57 @@ def check_project_results(project_id):
 def download_file(url, filename): 
     r = client.request('GET', url, preload_content=False, headers={"Authorization": f"Bearer {get_access_token()}"})
 
-    with open(filename, 'wb') as out:
-        chunk_size = 1024*1024 
-        while True:
-            data = r.read(chunk_size)
-            if not data:
-                break
-            out.write(data)
+    # The file is written to disk chunk by chunk as it arrives, so it is never held in memory as a whole.
+    chunk_size = 100*1024
+    try:
+        with open(filename, 'wb', buffering=chunk_size) as out:
+            shutil.copyfileobj(r, out, length=chunk_size)
+    finally:
+        r.release_conn()
 
-    r.release_conn()
+###############################################################
+# TASK 2. HOW TO OPEN THE EDITOR ON THE FRONTEND (NO DESIGN). #
+###############################################################
 
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-
-    ###############################################################
-    # TASK 2. HOW TO OPEN THE EDITOR ON THE FRONTEND (NO DESIGN). #
-    ###############################################################
-
-    # In this case we want to open an empty Design Editor with a blank artboard of a specific size. 
-    # The simplest way is to use the IFrameAPI library, described here:
-    # 
-    # https://customerscanvas.com/dev/editors/iframe-api/overview.html 
-    #
-    # In short, you need to add several elements to your HTML page:
-    # 1. Add the link to IFrameAPI library of Design Editor of the version installed to your Customer's Canvas account.
-    # 2. Add `<iframe>` element to the page where you want to show the editor.
-    # 3. Add a button which will cause Design Editor to save the result.
-    # 4. Add a script which initializes the editor by referencing to the iframe you have added.
-    # 5. To make the upload functionality to work correctly, it is also necessary to provide the user ID and Design Editor token 
-    #    as discussed above (as a part of the editor configuration).
-    #
-    # The base address of your Design Editor instance can be retrieved through API. See the `get_design_editor_url()` function
-    # above.
-    # 
-    # When adding a script, you need also to add the `id='CcIframeApiScript'` attribute to the `<script>` tag.
-    #
-    # To load the editor to the `<iframe>` element, you need to call the `CustomersCanvas.IframeApi.loadEditor()` JS function.
-    # It requires three params - a reference to iframe, product definition, and editor config.
-    #
-    # Design Editor supports various product definitions, including design ID from your Customer's Canvas account. However, in our
-    # scenario, we want to have a blank design. In this case, we can specify width and height in points (1 point = 1/72 inch). In
-    # this sample, we convert inch values to points. More details about product definition options can be found here: 
-    # 
-    # https://customerscanvas.com/dev/editors/iframe-api/product-definition/examples.html
-    # (note, some of them are not relevant to the cloud installation of Customer's Canvas)
-    #
-    # As for the editor config, it is quite large structure. It allows for very detailed configuration of the user interface
-    # (like what toolbox buttons are available, colors in the color picker, images in the gallery, etc). Learn more here:  
-    # https://customerscanvas.com/dev/editors/iframe-api/editor-configuration/intro.html    
-    #
-    # When you are ready to save the result, you need to use the `editor.saveProduct()` method and receive the private design
-    # file ID (we also call the state files). After that we pass this ID to the backend part (see below) to convert it to JPEG. 
+# In this case we want to open an empty Design Editor with a blank artboard of a specific size. 
+# The simplest way is to use the IFrameAPI library, described here:
+# 
+# https://customerscanvas.com/dev/editors/iframe-api/overview.html 
+#
+# In short, you need to add several elements to your HTML page:
+# 1. Add the link to IFrameAPI library of Design Editor of the version installed to your Customer's Canvas account.
+# 2. Add `<iframe>` element to the page where you want to show the editor.
+# 3. Add a button which will cause Design Editor to save the result.
+# 4. Add a script which initializes the editor by referencing to the iframe you have added.
+# 5. To make the upload functionality to work correctly, it is also necessary to provide the user ID and Design Editor token 
+#    as discussed above (as a part of the editor configuration).
+#
+# The base address of your Design Editor instance can be retrieved through API. See the `get_design_editor_url()` function
+# above.
+# 
+# When adding a script, you need also to add the `id='CcIframeApiScript'` attribute to the `<script>` tag.
+#
+# To load the editor to the `<iframe>` element, you need to call the `CustomersCanvas.IframeApi.loadEditor()` JS function.
+# It requires three params - a reference to iframe, product definition, and editor config.
+#
+# Design Editor supports various product definitions, including design ID from your Customer's Canvas account. However, in our
+# scenario, we want to have a blank design. In this case, we can specify width and height in points (1 point = 1/72 inch). In
+# this sample, we convert inch values to points. More details about product definition options can be found here: 
+# 
+# https://customerscanvas.com/dev/editors/iframe-api/product-definition/examples.html
+# (note, some of them are not relevant to the cloud installation of Customer's Canvas)
+#
+# As for the editor config, it is quite large structure. It allows for very detailed configuration of the user interface
+# (like what toolbox buttons are available, colors in the color picker, images in the gallery, etc). Learn more here:  
+# https://customerscanvas.com/dev/editors/iframe-api/editor-configuration/intro.html    
+#
+# When you are ready to save the result, you need to use the `editor.saveProduct()` method and receive the private design
+# file ID (we also call the state files). After that we pass this ID to the backend part (see below) to convert it to JPEG. 
+#
+# The HTML page below is prepared once when the script starts. The `get_editor_page()` function only substitutes
+# the values which depend on the user and your tenant settings, and keeps the result for a few minutes.
 
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(str.encode("""
+_HTML_TEMPLATE = """
 <html>
   <head>
     <style> 
@@ -366,10 +417,45 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
     </script>
   </body>
 </html>
-""".format(
-        user_id=your_system_user_id, 
-        design_editor_token=get_design_editor_token(your_system_user_id), 
-        design_editor_url=get_design_editor_url())))
+"""
+
+# How long (in seconds) a rendered page is reused for the same user before requesting a new Design Editor token.
+page_cache_ttl = 300
+
+_page_cache = {}
+
+def get_editor_page(user_id):
+    cached_page = _page_cache.get(user_id)
+    if cached_page and time.monotonic() < cached_page["expires_at"]:
+        return cached_page["page"]
+
+    applications = get_tenant_applications()
+    page = _HTML_TEMPLATE.format(
+        user_id=user_id, 
+        design_editor_token=get_design_editor_token(user_id), 
+        design_editor_url=applications['designEditorUrl']).encode('utf-8')
+
+    _page_cache[user_id] = {"page": page, "expires_at": time.monotonic() + page_cache_ttl}
+
+    return page
+
+class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 lets the browser keep the connection open and reuse it for the next requests (like the
+    # POST request sent when saving the design). For that, every response must specify its Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    # Close idle keep-alive connections after this number of seconds, so they don't occupy handler threads forever.
+    timeout = 30
+
+    def do_GET(self):
+        body = get_editor_page(your_system_user_id)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     ###############################################################
     # TASK 3. HOW TO CONVERT DESIGN FILE (AKA STATE FILE) TO JPEG #
@@ -389,11 +475,10 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         
         # From the frontend we will receive the ID of a design file created by the user as well as the user id.
         content_length = int(self.headers['Content-Length'])
-        body = self.rfile.read(content_length)
-        body_as_string = body.decode('utf8')
+        payload = _loads(self.rfile.read(content_length))
 
-        state_id = json.loads(body_as_string)['stateId']
-        user_id = json.loads(body_as_string)['userId']
+        state_id = payload['stateId']
+        user_id = payload['userId']
 
         # This function is declared above. It creates a project in Customer's Canvas and runs a built-in 
         # rendering pipeline. Here you pass some settings, like output file format and resolution. 
@@ -401,65 +486,110 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         
         # Note, the rendering process run asyncronously. For lightweight designs it should be finished
         # almost immediately, but some slight delays still may happen. That's why you need to implement 
-        # polling mechanism - check a project status, if it is still Pending, wait for few seconds and try again.
-        # Don't forget to limit a number of retries to prevent endless loop in case if something goes wrong.
+        # polling mechanism - check a project status, if it is still Pending, wait a bit and try again.
+        # We start with a short delay and increase it after each attempt (exponential backoff), so that
+        # fast renders are picked up quickly while slow ones don't flood the API with requests.
+        # Don't forget to limit the total waiting time to prevent endless loop in case if something goes wrong.
 
         isPending = True
         isSuccess = False
         failureDetails = ''
-        counter = 0
-
-        while isPending and counter < 20: 
-            time.sleep(3)
-
-            # This function is declared above. It receives an object called "processing results".
-            # It includes a status = Pending | InProgress | Completed | Failed. In case
-            # of status = Completed, it also includes file details (potentially, a rendering pipeline may 
-            # create multiple files, however, in our case it will be only one file).   
-            project_results = check_project_results(project["id"])
-            project_status = project_results["status"]
-
-            if project_status == "Completed":
-
-                file_details = project_results["outputFileDetails"]
-                for result_info in file_details:
-                    # This function is declared above. It downloads a file from the url
-                    # and saves it as a file. It assumes that you download it from Customer's Canvas
-                    # and adds the Authorization header with a token.
-                    download_file(result_info["url"], f'{result_info["name"]}.jpg')
-
-                isPending = False
-                isSuccess = True
+        min_delay = 0.25
+        max_delay = 5.0
+        delay = min_delay
+        deadline = time.monotonic() + 60
+
+        # The stored processing results are removed when polling stops for any reason (finished rendering,
+        # timeout, shutdown or an error).
+        try:
+            while isPending: 
+                # This function is declared above. It receives an object called "processing results".
+                # It includes a status = Pending | InProgress | Completed | Failed. In case
+                # of status = Completed, it also includes file details (potentially, a rendering pipeline may 
+                # create multiple files, however, in our case it will be only one file).   
+                project_results = check_project_results(project["id"])
+                project_status = project_results["status"]
+
+                if project_status == "Completed":
+
+                    file_details = project_results["outputFileDetails"]
+
+                    # Make sure a valid access token is cached, so that all downloads share it
+                    # instead of requesting their own tokens at the same time.
+                    get_access_token()
+
+                    # If there are several files, they are downloaded in parallel.
+                    with ThreadPoolExecutor(max_workers=4) as executor:
+                        # This function is declared above. It downloads a file from the url
+                        # and saves it as a file. It assumes that you download it from Customer's Canvas
+                        # and adds the Authorization header with a token.
+                        list(executor.map(
+                            lambda result_info: download_file(result_info["url"], f'{result_info["name"]}.jpg'), 
+                            file_details))
+
+                    isPending = False
+                    isSuccess = True
+
+                elif project_status == "Failed":
+                    # If the rendering pipeline fails, you can see the error details. 
+                    # Alternatively, you can sign in to Customer's Canvas account, find the 
+                    # project there, and see the rendering pipeline run report.
+                    failureDetails = project_results.get("statusDescription") or ""
+
+                    isPending = False
+                    isSuccess = False
+
+                # other options are project_results.status == "InProgress" or "Pending" 
+                # we will wait and loop again with isPending = True. If the server suggests
+                # how long to wait, use its value instead of our own delay. The wait never goes beyond
+                # the total waiting time, and after the last wait we check the results once more.
+                if isPending:
+                    remaining_time = deadline - time.monotonic()
+                    if remaining_time <= 0:
+                        break
+
+                    retry_after = project_results.get("retryAfterSeconds")
+                    if isinstance(retry_after, (int, float)) and not isinstance(retry_after, bool):
+                        wait_time = max(retry_after, min_delay)
+                    else:
+                        wait_time = delay
+
+                    if _shutdown.wait(min(wait_time, remaining_time)):
+                        body = b'Server is shutting down.'
+                        self.send_response(503)
+                        self.send_header('Content-type', 'text/html')
+                        self.send_header('Content-Length', str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                        return
+                    delay = min(delay * 1.7, max_delay)
+        finally:
+            _project_results_cache.pop(project["id"], None)
 
-            elif project_status == "Failed":
-                # If the rendering pipeline fails, you can see the error details. 
-                # Alternatively, you can sign in to Customer's Canvas account, find the 
-                # project there, and see the rendering pipeline run report.
-                failureDetails = project_results.statusDescription
+        if isSuccess:
+            body = b'Successfully saved a file.'
+        else: 
+            body = b'Failed to render a file.' + failureDetails.encode('utf-8')
 
-                isPending = False
-                isSuccess = False
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-            # other options are project_results.status == "InProgress" or "Pending" 
-            # we will loop again with isPending = True
-            counter += 1
 
-        if isSuccess:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            response = BytesIO()
-            response.write(b'Successfully saved a file.')
-        else: 
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            response = BytesIO()
-            response.write(b'Failed to render a file.')
-            response.write(str.encode(failureDetails))
+# Each request is handled in its own thread, so the editor page can still be served while another
+# request is waiting for the rendering results.
+httpd = ThreadingHTTPServer(('localhost', 8000), SimpleHTTPRequestHandler)
+httpd.daemon_threads = True
 
-        self.wfile.write(response.getvalue())
+# On Ctrl+C, interrupt the pending polling loops and stop the server. `shutdown()` waits for `serve_forever()`
+# to finish, that's why it is called from a separate thread and not right from the signal handler.
+def stop_server(signum, frame):
+    _shutdown.set()
+    threading.Thread(target=httpd.shutdown).start()
 
+signal.signal(signal.SIGINT, stop_server)
 
-httpd = HTTPServer(('localhost', 8000), SimpleHTTPRequestHandler)
-httpd.serve_forever()
\ No newline at end of file
+httpd.serve_forever()
+httpd.server_close()